@@ -1,7 +1,17 @@
+import hashlib
+import io
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import requests
 import streamlit as st
 import pandas as pd
 import numpy as np
-import pydeck as pdk
+import pyarrow as pa
+import pyarrow.compute as pc
+from streamlit.components.v1 import html as st_html
 
 st.set_page_config(page_title="Global Earthquakes Dashboard", page_icon="🌍", layout="wide")
 st.title("🌍 실시간 지진 대시보드 (USGS) + 대륙/국가 집계")
@@ -18,9 +28,30 @@ def coalesce_col(df: pd.DataFrame, targets, fallback=None, cast=None):
     df[targets[0]] = fallback
     return df[targets[0]]
 
+def place_mask(place: pd.Series, q: str) -> np.ndarray:
+    """대소문자 무시 부분 문자열 검색. Arrow 문자열이면 pyarrow.compute 로 벡터화."""
+    if isinstance(place.dtype, pd.StringDtype) and place.dtype.storage == "pyarrow":
+        hit = pc.match_substring(pa.array(place), q, ignore_case=True)
+        return pc.fill_null(hit, False).to_numpy(zero_copy_only=False)
+    return place.str.contains(q, case=False, na=False, regex=False).to_numpy()
+
+@st.cache_resource(show_spinner=False)
+def _pdk():
+    """pydeck 은 지도 탭을 그릴 때 처음 import (첫 화면 표시를 막지 않음)."""
+    import pydeck
+    return pydeck
+
 # ---------------------------
 # 1) 컨트롤
 # ---------------------------
+period_map = {"최근 24시간": "day", "최근 7일": "week", "최근 30일": "month"}
+mag_map = {"전체(all)": "all", "M2.5+": "2.5", "M4.5+": "4.5", "Significant": "significant"}
+# (기간, 규모 구간) 12개 조합의 피드 URL 을 미리 만들어 둠
+URLS = {
+    (p, m): f"https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/{m}_{p}.csv"
+    for p in period_map.values() for m in mag_map.values()
+}
+
 col0, col1, col2, col3 = st.columns([1.2,1,1,1])
 with col0:
     period = st.selectbox("기간", ["최근 24시간", "최근 7일", "최근 30일"], index=1)
@@ -31,70 +62,111 @@ with col2:
 with col3:
     q = st.text_input("지역 키워드(예: Japan, Alaska 등)", "")
 
-period_map = {"최근 24시간": "day", "최근 7일": "week", "최근 30일": "month"}
-mag_map = {"전체(all)": "all", "M2.5+": "2.5", "M4.5+": "4.5", "Significant": "significant"}
-URL = f"https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/{mag_map[mag_class]}_{period_map[period]}.csv"
+URL = URLS[(period_map[period], mag_map[mag_class])]
 
 # ---------------------------
 # 2) 데이터 로드 & 스키마 정규화
 # ---------------------------
-@st.cache_data(ttl=3600, show_spinner=False)
-def load_data(url: str) -> pd.DataFrame:
-    df = pd.read_csv(url)
-    # 시간
-    if "time" in df.columns:
-        df["time"] = pd.to_datetime(df["time"], errors="coerce", utc=True)
-    else:
-        df["time"] = pd.NaT
+# 앱에서 실제로 쓰는 컬럼만 파싱 (나머지 컬럼은 읽지 않음)
+USECOLS = ["time", "latitude", "longitude", "mag", "depth", "place", "type", "status", "id"]
+STR_DTYPES = {c: "string[pyarrow]" for c in ["place", "type", "status", "id"]}
 
-    # 위경도/규모/깊이 표준화
-    # 일부 환경에서 dtype 문제로 에러날 수 있으니 to_numeric 사용
-    df.rename(columns={"latitude":"lat", "longitude":"lon", "mag":"magnitude"}, inplace=True)
+CACHE_DIR = Path.home() / ".cache" / "usgs"
+# 디스크 캐시와 st.cache_data 가 겹쳐 쌓이므로 각각 30분 → 화면 데이터는 최대 1시간 경과
+CACHE_TTL = 1800
 
-    for col in ["lat", "lon", "magnitude", "depth"]:
-        if col not in df.columns:
-            df[col] = np.nan
-        df[col] = pd.to_numeric(df[col], errors="coerce")
+def fetch_csv(url: str, ttl: int = CACHE_TTL) -> tuple:
+    """디스크 캐시(Parquet)가 ttl 이내면 재사용, 아니면 다운로드 후 저장.
+
+    (DataFrame, 받아온 시각) 을 반환. 시각은 이 데이터를 식별하는 토큰으로 쓰임.
+    """
+    path = CACHE_DIR / f"{hashlib.sha1(url.encode()).hexdigest()}.parquet"
+    try:
+        fetched_at = path.stat().st_mtime
+        if time.time() - fetched_at < ttl:
+            # Parquet 왕복 시 string[python] 으로 돌아올 수 있으므로 Arrow 문자열로 복원
+            return pd.read_parquet(path).astype(STR_DTYPES), fetched_at
+    except (OSError, ValueError):
+        pass  # 캐시 없음/손상 → 새로 받기
+
+    fetched_at = time.time()
+    resp = requests.get(url, timeout=10)
+    resp.raise_for_status()
+    # pyarrow 엔진: 위경도/규모/깊이는 float64, 문자열은 Arrow 기반으로 바로 나옴
+    df = pd.read_csv(io.BytesIO(resp.content), engine="pyarrow", usecols=USECOLS, dtype=STR_DTYPES)
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # 임시 파일에 쓰고 교체 → 동시 세션이 쓰다 만 파일을 읽지 않음
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        os.close(fd)
+        try:
+            df.to_parquet(tmp, compression="zstd", index=False)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    except OSError:
+        pass  # 읽기 전용 환경이면 디스크 캐시 없이 진행
+    return df, fetched_at
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=12, show_spinner=False)
+def load_data(url: str) -> tuple:
+    """정규화된 DataFrame 과 fetch 토큰(받아온 시각)을 반환."""
+    df, fetched_at = fetch_csv(url)
+    # 시간 (ISO8601 고정 포맷 → 빠른 파싱 경로)
+    df["time"] = pd.to_datetime(df["time"], errors="coerce", utc=True, format="ISO8601")
+
+    df.rename(columns={"latitude":"lat", "longitude":"lon", "mag":"magnitude"}, inplace=True)
 
     # 문자열 컬럼 안전 처리
-    if "place" not in df.columns:
-        df["place"] = ""
-    else:
-        df["place"] = df["place"].fillna("")
+    df["place"] = df["place"].fillna("")
 
-    # id 없으면 만들어주기
-    if "id" not in df.columns:
-        df["id"] = pd.util.hash_pandas_object(df[["time","lat","lon"]], index=False).astype(str)
+    # 유효 자릿수가 작으므로 float32 로 다운캐스트 (메모리/대역폭 절반)
+    for c in ("lat", "lon", "magnitude", "depth"):
+        df[c] = pd.to_numeric(df[c], downcast="float")
 
-    return df
+    return df, fetched_at
 
 with st.spinner("데이터 불러오는 중..."):
-    df = load_data(URL)
+    df, fetched_at = load_data(URL)
 
-# 필터
-f = df.copy()
+# 필터 (마스크 하나로 합쳐 한 번만 인덱싱)
+mask = df["magnitude"].fillna(0).to_numpy() >= min_mag
 if q:
-    f = f[f["place"].str.contains(q, case=False, na=False)]
-f = f[f["magnitude"].fillna(0) >= min_mag].copy()
+    mask &= place_mask(df["place"], q)
+f = df.loc[mask]
 
 # ---------------------------
 # 3) 대륙/국가 매핑 (선택적)
 # ---------------------------
-@st.cache_data(show_spinner=False)
+@st.cache_resource(show_spinner=False)
+def get_geocoder():
+    """GeoNames KD-트리는 빌드가 무거우므로 프로세스당 한 번만 생성."""
+    import reverse_geocoder as rg
+    return rg.RGeocoder(mode=2, verbose=False)
+
+@st.cache_resource(show_spinner=False)
+def country_tables() -> tuple:
+    """ISO2 코드 → 국가명 / 대륙 전체 사전. 프로세스당 한 번만 생성."""
+    from country_converter import CountryConverter
+    data = CountryConverter().data.dropna(subset=["ISO2"])
+    return dict(zip(data["ISO2"], data["name_short"])), dict(zip(data["ISO2"], data["continent"]))
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=12, show_spinner=False)
 def enrich_country_continent(df_input: pd.DataFrame) -> pd.DataFrame:
     """reverse_geocoder + country_converter가 있을 때만 매핑."""
+    out = df_input.copy()
+    # 라이브러리 로드(첫 호출 시 import)만 보호 — 이후 계산 오류는 그대로 드러나게 둠
     try:
-        import reverse_geocoder as rg
-        from country_converter import CountryConverter
+        geocoder = get_geocoder()
+        name_map, cont_map = country_tables()
     except Exception:
-        # 라이브러리 없으면 원본 반환 (안전)
-        out = df_input.copy()
+        # 라이브러리 없거나 import 실패 → 원본 반환 (안전)
         out["country"] = np.nan
         out["continent"] = np.nan
         out["country_code"] = np.nan
         return out
 
-    out = df_input.copy()
     # 좌표 유효한 행만 매핑
     valid = out[["lat","lon"]].dropna()
     if valid.empty:
@@ -103,16 +175,23 @@ def enrich_country_continent(df_input: pd.DataFrame) -> pd.DataFrame:
         out["country_code"] = np.nan
         return out
 
-    coords = list(zip(valid["lat"].astype(float), valid["lon"].astype(float)))
-    hits = rg.search(coords, mode=2)  # 벡터화 모드
-    iso2 = pd.Series([h["cc"] for h in hits], index=valid.index)
-
-    out["country_code"] = np.nan
-    out.loc[iso2.index, "country_code"] = iso2.values
-
-    cc = CountryConverter()
-    out["country"] = cc.convert(out["country_code"], to="name_short", not_found=None)
-    out["continent"] = cc.convert(out["country_code"], to="continent", not_found=None)
+    # 0.25° 격자로 양자화 → 여진 군집처럼 겹치는 좌표는 한 번만 조회
+    keys = np.column_stack([
+        np.round(valid["lat"].to_numpy(float) * 4).astype(int),
+        np.round(valid["lon"].to_numpy(float) * 4).astype(int),
+    ])
+    unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    hits = geocoder.query((unique_keys / 4.0).tolist())
+    cc_per_row = np.array([h["cc"] for h in hits], dtype=object)[inverse.reshape(-1)]
+    # 좌표 없는 행은 NaN 으로 남음 (인덱스 정렬 대입)
+    out["country_code"] = pd.Series(cc_per_row, index=valid.index)
+
+    # 사전에 없는 코드는 코드 그대로 (convert(not_found=None) 와 같은 동작)
+    out["country"] = out["country_code"].map(name_map).fillna(out["country_code"])
+    out["continent"] = out["country_code"].map(cont_map).fillna(out["country_code"])
+    # 고유값이 적은 문자열 → category (메모리 절감, groupby 해시 테이블이 고유값 수만큼만)
+    out["country"] = out["country"].astype("category")
+    out["continent"] = out["continent"].astype("category")
     return out
 
 with st.spinner("위치 → 국가/대륙 매핑 중... (없어도 앱은 정상 동작)"):
@@ -138,102 +217,161 @@ tab_map, tab_trend, tab_region, tab_data = st.tabs(["🗺️ 지도", "📈 추
 with tab_map:
     st.subheader("📍 지진 위치 ")
     if len(f):
-        # 뷰포트
-        if f["lat"].notna().any() and f["lon"].notna().any():
-            lat_center = float(f["lat"].mean())
-            lon_center = float(f["lon"].mean())
+        pdk = _pdk()
+        # 뷰포트 (좌표 유효 마스크 하나로 존재 여부와 평균을 함께 계산)
+        lat_arr = f["lat"].to_numpy()
+        lon_arr = f["lon"].to_numpy()
+        has_pos = ~(np.isnan(lat_arr) | np.isnan(lon_arr))
+        if has_pos.any():
+            lat_center = float(lat_arr[has_pos].mean())
+            lon_center = float(lon_arr[has_pos].mean())
         else:
             lat_center, lon_center = 0.0, 0.0
 
-        mag = f["magnitude"].fillna(0).clip(lower=0, upper=8)
-        size_m = ((mag + 1.0) ** 2) * 6000
-        size_m = np.clip(size_m, 3000, 60000)
-
-        color = ((mag / 8) * 255).astype(int)
-        plot_df = f.assign(
-            color_r=color.clip(80, 255),
-            color_g=(120 - (color * 0.4)).clip(0, 120),
-            color_b=60,
-            size=size_m
-        )
-
-        scatter = pdk.Layer(
-            "ScatterplotLayer",
-            data=plot_df.dropna(subset=["lat","lon"]),
-            get_position='[lon, lat]',
-            get_radius='size',
-            radius_min_pixels=3,
-            radius_max_pixels=120,
-            get_fill_color='[color_r, color_g, color_b, 210]',
-            stroked=True,
-            get_line_color=[255, 255, 255],
-            line_width_min_pixels=1,
-            pickable=True,
-            auto_highlight=True
-        )
+        # 레이어에 필요한 컬럼만 담은 작은 페이로드 (원본 프레임 전체를 JSON 으로 보내지 않음)
+        pts = f[has_pos]
+        # 규모 → 크기/색 인코딩을 연속 NumPy 배열 한 번에 계산 (중간 Series 할당 없음)
+        mag = np.clip(np.nan_to_num(pts["magnitude"].to_numpy(np.float32)), 0, 8)
+        size_m = np.clip((mag + 1) ** 2 * 6000, 3000, 60000).astype(np.float32)
+        c = (mag * (255 / 8)).astype(np.int16)
+        r = np.clip(c, 80, 255).astype(np.uint8)
+        g = np.clip(120 - (c * 0.4).astype(np.int16), 0, 120).astype(np.uint8)
+        b = np.full_like(r, 60)
+        plot_df = pd.DataFrame({
+            # JSON 직렬화 시 float32 는 긴 십진 표현이 되므로 float64 로 올려 반올림
+            "lon": pts["lon"].to_numpy(np.float64).round(5),
+            "lat": pts["lat"].to_numpy(np.float64).round(5),
+            "r": r,
+            "g": g,
+            "b": b,
+            "radius": size_m.astype(np.int32),
+            "place": pts["place"].to_numpy(object),
+            "magnitude": pts["magnitude"].to_numpy(np.float64).round(2),
+            "depth": pts["depth"].to_numpy(np.float64).round(2),
+        })
+
+        # 포인트가 아주 많으면 겹침으로 프래그먼트가 N번 다시 그려지므로 육각 격자로 집계
+        many_points = len(plot_df) > 20000
+        aggregate = st.toggle("집계 표시", value=many_points, disabled=many_points,
+                              help="점 대신 육각 격자별 발생 수를 높이로 표시 (20,000개 초과 시 항상 켜짐)") or many_points
+        if aggregate:
+            points = pdk.Layer(
+                "HexagonLayer",
+                data=plot_df[["lon","lat"]],
+                get_position='[lon, lat]',
+                radius=30000,
+                elevation_scale=50,
+                extruded=True,
+                coverage=0.9,
+                pickable=True,
+                auto_highlight=True
+            )
+        else:
+            points = pdk.Layer(
+                "ScatterplotLayer",
+                data=plot_df,
+                get_position='[lon, lat]',
+                get_radius='radius',
+                radius_min_pixels=3,
+                radius_max_pixels=120,
+                get_fill_color='[r, g, b, 210]',
+                stroked=True,
+                get_line_color=[255, 255, 255],
+                line_width_min_pixels=1,
+                pickable=True,
+                auto_highlight=True
+            )
 
         show_density = st.toggle("밀도(Heatmap) 켜기", value=True, help="겹치는 지역을 색 번짐으로 강조")
-        heat = pdk.Layer(
-            "HeatmapLayer",
-            data=plot_df.dropna(subset=["lat","lon"])[["lon","lat","magnitude"]].rename(columns={"magnitude":"weight"}),
-            get_position='[lon, lat]',
-            get_weight="weight",
-            radius_pixels=40,
-            intensity=1.0
-        ) if show_density else None
-
-        view_state = pdk.ViewState(latitude=lat_center, longitude=lon_center, zoom=1.6, pitch=0, bearing=0)
-        layers = [scatter] if not show_density else [heat, scatter]
+        layers = [points]
+        if show_density:
+            # 토글이 켜졌을 때만 히트맵 페이로드 생성 (plot_df 는 이미 좌표 결측 제거됨)
+            heat = pdk.Layer(
+                "HeatmapLayer",
+                data=plot_df[["lon","lat","magnitude"]],
+                get_position='[lon, lat]',
+                get_weight="magnitude",
+                radius_pixels=40,
+                intensity=1.0
+            )
+            layers = [heat, points]
+
+        view_state = pdk.ViewState(latitude=lat_center, longitude=lon_center, zoom=1.6,
+                                   pitch=40 if aggregate else 0, bearing=0)
+        tooltip = ({"text": "이벤트 {elevationValue}건"} if aggregate
+                   else {"text": "{place}\nM{magnitude} • depth {depth} km"})
         deck = pdk.Deck(
             layers=layers,
             initial_view_state=view_state,
-            tooltip={"text": "{place}\nM{magnitude} • depth {depth} km"},
+            tooltip=tooltip,
             map_provider="carto"  # 토큰 없이 사용
         )
-        st.pydeck_chart(deck, use_container_width=True)
+        # 포인트가 많으면 st.pydeck_chart 의 프로토콜 직렬화를 건너뛰고 deck.gl HTML 을 직접 임베드
+        # (툴팁은 동작, 리런 시 뷰 상태는 유지되지 않음)
+        if len(plot_df) > 5000:
+            st_html(deck.to_html(as_string=True), height=620)
+        else:
+            st.pydeck_chart(deck, use_container_width=True)
     else:
         st.info("표시할 결과가 없습니다. 필터를 조정해 보세요.")
 
 # ===== 추세 =====
+BIN_3H_NS = 3 * 3600 * 1_000_000_000
+
+def bin_3h(t_ns: np.ndarray) -> pd.Series:
+    """epoch ns 배열 → 3시간 구간별 발생 수. 정렬/resample 없이 bincount 한 번."""
+    bins = t_ns // BIN_3H_NS
+    counts = np.bincount(bins - bins.min())
+    idx = pd.date_range(pd.Timestamp(int(bins.min()) * BIN_3H_NS, tz="UTC"),
+                        periods=len(counts), freq="3h", name="time")
+    return pd.Series(counts, index=idx, name="id")
+
 with tab_trend:
     st.subheader("🔢 규모 히스토그램")
     if len(f) and f["magnitude"].notna().any():
-        upper = float(max(8.0, f["magnitude"].max()))
-        hist = np.histogram(f["magnitude"].dropna(), bins=20, range=(0, upper))
-        st.bar_chart(pd.DataFrame({"count": hist[0]}, index=pd.Index(hist[1][:-1], name="mag")), use_container_width=True)
+        # 고정 폭 20구간 → 곱셈으로 구간 번호 계산 후 bincount (searchsorted 없음)
+        m = f["magnitude"].dropna().to_numpy(np.float32)
+        upper = max(8.0, float(m.max()))
+        idx = np.clip((m * (20.0 / upper)).astype(np.int32), 0, 19)
+        counts = np.bincount(idx, minlength=20)
+        edges = np.linspace(0, upper, 21)
+        st.bar_chart(pd.DataFrame({"count": counts}, index=pd.Index(edges[:-1], name="mag")), use_container_width=True)
 
     st.subheader("⏱️ 시간대별 발생 수(3시간 단위)")
     if len(f) and f["time"].notna().any():
-        ts = f.set_index("time").resample("3H")["id"].count()
+        ts = bin_3h(f["time"].dropna().to_numpy("datetime64[ns]").view("i8"))
         st.line_chart(ts, use_container_width=True)
 
 # ===== 지역 집계 =====
 with tab_region:
     st.subheader("🌐 대륙·국가별 집계")
     if len(f) and f["continent"].notna().any():
-        cont_df = (
+        # (대륙, 국가) 한 번의 groupby 로 합계/개수를 구하고 대륙 요약은 그 결과에서 롤업
+        g = (
             f.dropna(subset=["continent"])
-             .groupby("continent")
+             .groupby(["continent","country"], dropna=False, observed=True, sort=False)
              .agg(events=("id","count"),
                   max_mag=("magnitude","max"),
-                  avg_mag=("magnitude","mean"),
-                  avg_depth=("depth","mean"))
-             .sort_values("events", ascending=False)
-             .reset_index()
+                  sum_mag=("magnitude","sum"),
+                  n_mag=("magnitude","count"),
+                  sum_depth=("depth","sum"),
+                  n_depth=("depth","count"))
         )
+
+        def summarize(t: pd.DataFrame) -> pd.DataFrame:
+            return t.assign(avg_mag=t["sum_mag"] / t["n_mag"],
+                            avg_depth=t["sum_depth"] / t["n_depth"])[["events","max_mag","avg_mag","avg_depth"]]
+
+        cont_sums = g.groupby(level="continent", observed=True, sort=False).sum()
+        cont_sums["max_mag"] = g["max_mag"].groupby(level="continent", observed=True, sort=False).max()
+        cont_df = summarize(cont_sums).sort_values("events", ascending=False).reset_index()
         st.markdown("**대륙별 요약**")
         st.dataframe(cont_df, use_container_width=True)
         st.bar_chart(cont_df.set_index("continent")["events"], use_container_width=True)
 
         country_df = (
-            f.dropna(subset=["country"])
-             .groupby("country")
-             .agg(events=("id","count"),
-                  max_mag=("magnitude","max"),
-                  avg_mag=("magnitude","mean"),
-                  avg_depth=("depth","mean"))
-             .sort_values("events", ascending=False)
-             .head(20)
+            summarize(g.droplevel("continent").loc[lambda t: t.index.notna()])
+             .nlargest(20, "events")
              .reset_index()
         )
         st.markdown("**국가별 요약 (Top 20)**")
@@ -242,13 +380,21 @@ with tab_region:
         st.info("대륙/국가 매핑 결과가 없거나 라이브러리가 없습니다. (앱은 계속 사용 가능합니다)")
 
 # ===== 데이터 원본 =====
+@st.cache_data(ttl=CACHE_TTL, max_entries=12, show_spinner=False)
+def to_csv_bytes(df_key: tuple, _payload: pd.DataFrame) -> bytes:
+    """다운로드용 CSV 인코딩. 프레임 해싱 대신 가벼운 키(df_key)로 캐시."""
+    return _payload.to_csv(index=False).encode("utf-8")
+
 with tab_data:
     with st.expander("원본 데이터 보기 / 다운로드"):
         base_cols = ["time","magnitude","depth","place","lat","lon","type","status","id"]
         extra = [c for c in ["country","continent","country_code"] if c in f.columns]
         show_cols = [c for c in base_cols + extra if c in f.columns]
-        st.dataframe(f[show_cols], use_container_width=True)
-        st.download_button("CSV 다운로드", f[show_cols].to_csv(index=False).encode("utf-8"),
+        # Arrow Table 로 넘기면 Streamlit 내부의 pandas→Arrow 변환을 건너뜀
+        st.dataframe(pa.Table.from_pandas(f[show_cols], preserve_index=False), use_container_width=True)
+        # fetch 토큰 + 필터 입력이 f 를 결정 → 피드를 다시 받으면(기존 이벤트 수정 포함) 키가 바뀜
+        csv_bytes = to_csv_bytes((URL, fetched_at, q, min_mag, tuple(show_cols)), f[show_cols])
+        st.download_button("CSV 다운로드", csv_bytes,
                            "earthquakes_filtered.csv", "text/csv")
 
 st.caption("데이터 출처: USGS Earthquake Hazards Program. (대륙/국가 매핑은 선택적이며 라이브러리 없으면 생략)")